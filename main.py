@@ -1,14 +1,27 @@
+import json
 import random
-
-MAX_STEPS = 6
-STALL_STOP = None
-COST_PER_STEP = 9.50
-SEED = 2
-
-random.seed(SEED)
+import sys
+from collections import Counter, deque
+from typing import Any, Final, Optional, TypedDict
+
+MAX_STEPS: Final = 6
+STALL_STOP: Final[Optional[int]] = None
+REPEAT_STOP: Final[Optional[int]] = None  # stop once the same (plan, action) shows up this many times
+REPEAT_WINDOW: Final = 8  # ...within the last REPEAT_WINDOW steps
+COST_PER_STEP: Final = 9.50
+SEED: Final = 2
+FLUSH_EVERY: Final = 64  # write the trace to stdout every this many steps
+
+def check_config() -> None:
+    # The repeat window can't count a pair more than REPEAT_WINDOW times
+    repeat_stop = REPEAT_STOP
+    if repeat_stop is not None and repeat_stop > REPEAT_WINDOW:
+        raise ValueError(f"REPEAT_STOP ({repeat_stop}) can't exceed REPEAT_WINDOW ({REPEAT_WINDOW})")
+
+check_config()
 
 # Pretend "prompt" the code sends to a model
-ANALYZER_PROMPT = """
+ANALYZER_PROMPT: Final = """
 You are an assistant helping an agent accomplish a goal.
 Return a JSON object with keys:
 - "next_action": either "toggle_cheese" or "place_order"
@@ -16,74 +29,117 @@ Return a JSON object with keys:
 Return JSON only.
 """.strip()
 
-def call_model(prompt, order):
+def validate_model_data(data: dict[str, Any]) -> tuple[Optional[dict[str, Any]], str]:
+    """
+    Schema checks for decoded model output: required keys and an allowed next_action.
+    """
+    if "next_action" not in data or "reason" not in data:
+        return None, "SchemaError: missing keys"
+    if data["next_action"] not in ("toggle_cheese", "place_order"):
+        return None, "SchemaError: invalid next_action"
+
+    return data, "OK"
+
+# The two canonical "clean" model replies, decoded and schema-checked once at import
+VALID_RESPONSES: Final[dict[str, str]] = {
+    "YES": '{"next_action":"toggle_cheese","reason":"Cheese is still YES, try toggling it off."}',
+    "NO": '{"next_action":"place_order","reason":"Cheese is NO, place the order."}',
+}
+
+def load_canonical_reply(raw: str) -> dict[str, Any]:
+    # A canonical reply that fails the schema is a typo in VALID_RESPONSES: fail loudly
+    data, status = validate_model_data(json.loads(raw))
+    if data is None:
+        raise ValueError(f"canonical reply {raw!r} failed validation: {status}")
+    return data
+
+PARSED_RESPONSES: Final[dict[str, dict[str, Any]]] = {raw: load_canonical_reply(raw) for raw in VALID_RESPONSES.values()}
+
+def call_model(prompt: str, order: dict[str, str], roll: float) -> str:
     """
     Simulates an LLM. Sometimes returns clean JSON, sometimes returns messy text.
     This is intentional: agents must handle imperfect model output.
+    `roll` is this step's pre-drawn random number in [0, 1).
     """
     # 70% chance: valid JSON
-    if random.random() < 0.7:
-        if order["cheese"] == "YES":
-            return '{"next_action":"toggle_cheese","reason":"Cheese is still YES, try toggling it off."}'
-        return '{"next_action":"place_order","reason":"Cheese is NO, place the order."}'
+    if roll < 0.7:
+        return VALID_RESPONSES[order["cheese"]]
 
     # 30% chance: invalid / messy output
     return "I think you should toggle the cheese. next_action=toggle_cheese"
 
-def parse_model_output(raw_text):
+# First characters of a strict JSON value: object, array, string, number, true/false/null.
+# json.loads also takes the non-standard NaN/Infinity; leaving "N" and "I" out rejects
+# those on purpose (and keeps prose like "I think..." away from the parser).
+JSON_VALUE_STARTS: Final = frozenset('{["-0123456789tfn')
+
+def parse_model_output(raw_text: str) -> tuple[Optional[dict[str, Any]], str]:
     """
     Minimal parsing to keep the lesson focused:
     Accept only strict JSON with required keys. Otherwise reject.
     """
-    import json
+    # Fast path: a canonical reply that already passed the checks below.
+    # Hand out a copy so a caller can't change the cached dict for later parses.
+    cached = PARSED_RESPONSES.get(raw_text)
+    if cached is not None:
+        return dict(cached), "OK"
+
+    # Cheap reject: text that can't start a JSON value skips the parser entirely.
+    # Only JSON's own whitespace (space, tab, CR, LF) may come first.
+    text = raw_text.lstrip(" \t\r\n")
+    if not text or text[0] not in JSON_VALUE_STARTS:
+        return None, "ParseError: not valid JSON"
+
     try:
-        data = json.loads(raw_text)
-    except Exception:
+        data = json.loads(text)
+    except (ValueError, RecursionError):
         return None, "ParseError: not valid JSON"
 
     if not isinstance(data, dict):
         return None, "SchemaError: not a JSON object"
-    if "next_action" not in data or "reason" not in data:
-        return None, "SchemaError: missing keys"
-    if data["next_action"] not in ("toggle_cheese", "place_order"):
-        return None, "SchemaError: invalid next_action"
+    return validate_model_data(data)
 
-    return data, "OK"
+goal: Final = "Order a burrito bowl with NO cheese"
+
+# Plans are small ints; the human-readable text is only looked up when printing
+PLAN_TOGGLE: Final = 0
+PLAN_PLACE: Final = 1
+PLAN_LABELS: Final = ("Try a quick fix: toggle the cheese setting", "Place the order")
+FALLBACK_LABELS: Final = ("Fallback: toggle cheese (heuristic)", "Fallback: place order (heuristic)")
+NEXT_ACTION_PLANS: Final[dict[str, int]] = {"toggle_cheese": PLAN_TOGGLE, "place_order": PLAN_PLACE}
 
-goal = "Order a burrito bowl with NO cheese"
-order = {"item": "burrito bowl", "cheese": "YES"}
-repeat_count = 0
-cost = 0.0
+class PlanBundle(TypedDict):
+    plan: int  # PLAN_TOGGLE or PLAN_PLACE
+    fallback: bool  # True when the model output was rejected and the heuristic chose
+    raw: str  # what the model actually said
+    parse: str  # parse_model_output() status
 
-def plan(order):
+def plan(order: dict[str, str], roll: float) -> PlanBundle:
     # Code prepares context + prompt for the model
     prompt = f"{ANALYZER_PROMPT}\n\nGOAL: {goal}\nCURRENT_ORDER: {order}"
-    raw = call_model(prompt, order)
+    raw = call_model(prompt, order, roll)
 
     # Code parses and validates before trusting the output
     parsed, parse_status = parse_model_output(raw)
 
     if parsed is None:
         # Fallback: code refuses to trust model output and uses a safe heuristic
-        if order["cheese"] == "YES":
-            return {"plan_text": "Fallback: toggle cheese (heuristic)", "raw": raw, "parse": parse_status}
-        return {"plan_text": "Fallback: place order (heuristic)", "raw": raw, "parse": parse_status}
-
-    # Convert structured plan into the plan_text your act() already expects
-    if parsed["next_action"] == "toggle_cheese":
-        plan_text = "Try a quick fix: toggle the cheese setting"
+        plan_idx = PLAN_TOGGLE if order["cheese"] == "YES" else PLAN_PLACE
+        fallback = True
     else:
-        plan_text = "Place the order"
+        # Convert the structured next_action into a plan id
+        plan_idx = NEXT_ACTION_PLANS[parsed["next_action"]]
+        fallback = False
 
-    return {"plan_text": plan_text, "raw": raw, "parse": parse_status}
+    return {"plan": plan_idx, "fallback": fallback, "raw": raw, "parse": parse_status}
 
-def act(plan_text, order):
+def act(plan_idx: int, order: dict[str, str]) -> str:
     # The bug: the agent THINKS it toggled cheese, but the order doesn't actually change.
-    if "toggle" in plan_text:
+    if plan_idx == PLAN_TOGGLE:
         return "Clicked 'No cheese' (but it didn't save)"
     return "Placed order"
 
-def check(action, order):
+def check(action: str, order: dict[str, str]) -> tuple[str, str]:
     # "Reality check": what we actually ordered
     if action == "Placed order":
         if order["cheese"] == "NO":
@@ -91,40 +147,94 @@ def check(action, order):
         return "FAIL", "Order still has cheese"
     return "FAIL", "No real change happened"
 
-print("\n=== Agent Trace: Plan → Act → Check → Decide ===")
-print(f"GOAL: {goal}\n")
-print("STEP | plan                           | model_out (short)                 | parse | action                              | check   | cost   | decision")
-print("-----------------------------------------------------------------------------------------------------------------------------------")
-
-for step in range(1, MAX_STEPS + 1):
-    plan_bundle = plan(order)
-    plan_text = plan_bundle["plan_text"]
-    raw_short = plan_bundle["raw"][:28].replace("\n", " ") + ("…" if len(plan_bundle["raw"]) > 28 else "")
-    parse_status = plan_bundle["parse"]
-    action = act(plan_text, order)
-    status, evidence = check(action, order)
-
-    # Cost only happens when the agent places an order
-    if action == "Placed order":
-        cost += COST_PER_STEP
-
-    # Stall detection: did we make any real progress toward the goal?
-    # Progress means order['cheese'] flips to "NO".
-    if order["cheese"] == "YES":
-        repeat_count += 1
-    else:
-        repeat_count = 0
-
-    if status == "SUCCESS":
-        print(f"{step:>4} | {plan_text:<30} | {raw_short:<30} | {parse_status:<5} | {action:<34} | FAIL   | ${cost:<5.2f} | ✅ stop (done)")
-        break
-
-    if STALL_STOP is not None and repeat_count >= STALL_STOP:
-        print(f"{step:>4} | {plan_text:<34} | {action:<34} | FAIL   | ${cost:<5.2f} | 🛑 stop (stalled → ask human)")
-        print(f"{step:>4} | {plan_text:<30} | {raw_short:<30} | {parse_status:<5} | {action:<34} | FAIL   | ${cost:<5.2f} | 🛑 stop (stalled → ask human)")
-        break
-
-    print(f"{step:>4} | {plan_text:<30} | {raw_short:<30} | {parse_status:<5} | {action:<34} | FAIL   | ${cost:<5.2f} | continue")
-
-if STALL_STOP is None:
-    print("\nNote: We only stopped because MAX_STEPS ended (no guardrail).")
+# One trace row; the format string is parsed once and reused for every step
+ROW_TEMPLATE: Final = "{step:>4} | {plan_text:<30} | {raw_short:<30} | {parse_status:<5} | {action:<34} | FAIL   | ${cost:<5.2f} | {decision}\n"
+format_row: Final = ROW_TEMPLATE.format
+
+def flush_trace(buf: list[str]) -> None:
+    # One sys.stdout.write per batch of rows instead of one print per row
+    sys.stdout.write("".join(buf))
+    sys.stdout.flush()
+    buf.clear()
+
+def run_agent_loop(seed: int = SEED) -> None:
+    # Private RNG seeded per run: every call replays the same trace and the
+    # global random state is left alone
+    rng = random.Random(seed)
+
+    # Bind globals to locals once so the loop body uses fast local lookups
+    max_steps = MAX_STEPS
+    stall_stop = STALL_STOP
+    repeat_stop = REPEAT_STOP
+    cost_per_step = COST_PER_STEP
+    flush_every = FLUSH_EVERY
+    fmt = format_row
+
+    order = {"item": "burrito bowl", "cheese": "YES"}
+    repeat_count = 0
+    cost = 0.0
+
+    # Collect trace lines and write them to stdout in batches
+    trace: list[str] = []
+    trace.append("\n=== Agent Trace: Plan → Act → Check → Decide ===\n")
+    trace.append(f"GOAL: {goal}\n\n")
+    trace.append("STEP | plan                           | model_out (short)                 | parse | action                              | check   | cost   | decision\n")
+    trace.append("-----------------------------------------------------------------------------------------------------------------------------------\n")
+
+    # Draw every step's model "roll" up front instead of one RNG call per step
+    rolls: list[float] = [rng.random() for _ in range(max_steps)]
+
+    # Loop detection: recent (plan, action) pairs and how often each appears
+    recent: deque[tuple[int, str]] = deque(maxlen=REPEAT_WINDOW)
+    seen: Counter[tuple[int, str]] = Counter()
+
+    for step in range(1, max_steps + 1):
+        plan_bundle = plan(order, rolls[step - 1])
+        plan_idx = plan_bundle["plan"]
+        plan_text = (FALLBACK_LABELS if plan_bundle["fallback"] else PLAN_LABELS)[plan_idx]
+        raw_short = plan_bundle["raw"][:28].replace("\n", " ") + ("…" if len(plan_bundle["raw"]) > 28 else "")
+        parse_status = plan_bundle["parse"]
+        action = act(plan_idx, order)
+        status, evidence = check(action, order)
+
+        # Cost only happens when the agent places an order
+        if action == "Placed order":
+            cost += cost_per_step
+
+        # Stall detection: did we make any real progress toward the goal?
+        # Progress means order['cheese'] flips to "NO".
+        repeat_count = repeat_count + 1 if order["cheese"] == "YES" else 0
+
+        # Repeat detection: is the agent doing the exact same thing over and over?
+        repeating = False
+        if repeat_stop is not None:
+            pair = (plan_idx, action)
+            if len(recent) == recent.maxlen:
+                seen[recent[0]] -= 1
+            recent.append(pair)
+            seen[pair] += 1
+            repeating = seen[pair] >= repeat_stop
+
+        if status == "SUCCESS":
+            trace.append(fmt(step=step, plan_text=plan_text, raw_short=raw_short, parse_status=parse_status, action=action, cost=cost, decision="✅ stop (done)"))
+            break
+
+        if stall_stop is not None and repeat_count >= stall_stop:
+            trace.append(fmt(step=step, plan_text=plan_text, raw_short=raw_short, parse_status=parse_status, action=action, cost=cost, decision="🛑 stop (stalled → ask human)"))
+            break
+
+        if repeating:
+            trace.append(fmt(step=step, plan_text=plan_text, raw_short=raw_short, parse_status=parse_status, action=action, cost=cost, decision="🔁 stop (repeating → ask human)"))
+            break
+
+        trace.append(fmt(step=step, plan_text=plan_text, raw_short=raw_short, parse_status=parse_status, action=action, cost=cost, decision="continue"))
+        if step % flush_every == 0:
+            flush_trace(trace)
+
+    if stall_stop is None and repeat_stop is None:
+        trace.append("\nNote: We only stopped because MAX_STEPS ended (no guardrail).\n")
+
+    flush_trace(trace)
+
+if __name__ == "__main__":
+    run_agent_loop()